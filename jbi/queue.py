@@ -22,16 +22,20 @@ Classes:
       item and parse it as an item
 """
 
+import asyncio
+import contextlib
+import errno
 import logging
+import os
 import re
 import tempfile
+import time
 import traceback
 from abc import ABC, abstractmethod
 from datetime import datetime
 from functools import cached_property, lru_cache
-from json import JSONDecodeError
 from pathlib import Path
-from typing import AsyncIterator, Optional
+from typing import AsyncIterator, Iterator, Optional
 from urllib.parse import ParseResult, urlparse
 
 import dockerflow.checks
@@ -42,6 +46,9 @@ from jbi.environment import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Temporary item files older than this were left behind by a crashed write.
+STALE_TMP_FILE_SECONDS = 60
+
 ITEM_ID_PATTERN = re.compile(
     r"(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\+\d{2}:\d{2})-(?P<bug_id>\d+)-(?P<action>\w*)-(?P<status>error|postponed)"
 )
@@ -55,6 +62,21 @@ def extract_bug_id_from_item_id(item_id: str) -> str:
     )
 
 
+def iter_json_files(root: Path | str) -> Iterator[os.DirEntry]:
+    """Recursively yield the `*.json` files found under `root`, in no particular
+    order. A missing `root` yields nothing.
+    """
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_json_files(entry.path)
+                elif entry.name.endswith(".json"):
+                    yield entry
+    except FileNotFoundError:
+        return
+
+
 class QueueItemRetrievalError(Exception):
     def __init__(self, message=None, path=None):
         self.message = message or "Error reading or parsing queue item"
@@ -75,7 +97,8 @@ class PythonException(BaseModel, frozen=True):
 
     @classmethod
     def from_exc(cls, exc: Exception):
-        return PythonException(
+        # Fields are all strings we build here, skip validation.
+        return cls.model_construct(
             type=exc.__class__.__name__,
             description=str(exc),
             details="".join(traceback.format_exception(exc)),
@@ -102,7 +125,7 @@ class QueueItem(BaseModel, frozen=True):
         return self.payload.event.time
 
     @computed_field  # type: ignore
-    @property
+    @cached_property
     def identifier(self) -> str:
         return f"{self.payload.event.time}-{self.payload.bug.id}-{self.payload.event.action}-{'error' if self.error else 'postponed'}"
 
@@ -154,14 +177,20 @@ class QueueBackend(ABC):
         """
         pass
 
+    @abstractmethod
+    async def has_items(self, bug_id: int) -> bool:
+        """Report whether there is at least one item queued for `bug_id`"""
+        pass
+
     @abstractmethod
     async def get_all(self) -> dict[int, AsyncIterator[QueueItem]]:
         """Retrieve all items in the queue, grouped by bug
 
         Returns:
-            dict[int, List[QueueItem]]: Returns a dict of
-            {bug_id: list of events}. Each list of events sorted in ascending
-            order by the timestamp of the payload event.
+            dict[int, AsyncIterator[QueueItem]]: Returns a dict of
+            {bug_id: events iterator}. Items are only loaded as each iterator
+            is consumed, in ascending order by the timestamp of the payload
+            event.
         """
         pass
 
@@ -175,6 +204,8 @@ class FileBackend(QueueBackend):
     def __init__(self, location):
         self.location = Path(location)
         self.location.mkdir(parents=True, exist_ok=True)
+        # Plain string paths are cheaper to build on the put/remove hot path.
+        self.location_str = str(self.location)
 
     def __repr__(self) -> str:
         return f"FileBackend({self.location})"
@@ -197,32 +228,66 @@ class FileBackend(QueueBackend):
                 (root / name).rmdir()
 
     async def put(self, item: QueueItem):
-        folder = self.location / f"{item.payload.bug.id}"
-        folder.mkdir(exist_ok=True)
-        path = folder / (item.identifier + ".json")
-        path.write_text(item.model_dump_json())
+        folder = os.path.join(self.location_str, str(item.payload.bug.id))
+        path = os.path.join(folder, item.identifier + ".json")
+        # Write aside and rename, so that readers never see a partial item.
+        tmp_path = path + ".tmp"
+        try:
+            f = open(tmp_path, "w", encoding="utf-8")
+        except FileNotFoundError:
+            # First item for this bug. The folder is not cached as existing,
+            # since the retry job removes it from another process once empty.
+            os.makedirs(folder, exist_ok=True)
+            f = open(tmp_path, "w", encoding="utf-8")
+        try:
+            with f:
+                f.write(item.model_dump_json())
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            # Drop the bug folder if this was its first item.
+            with contextlib.suppress(OSError):
+                os.rmdir(folder)
+            raise
         logger.debug(
             "Wrote item %s for bug %s to path %s",
             item.identifier,
             item.payload.bug.id,
             path,
         )
-        logger.debug("%d items in dead letter queue", await self.size())
+        if logger.isEnabledFor(logging.DEBUG):
+            # Counting walks the whole queue folder, only do it when logged.
+            logger.debug("%d items in dead letter queue", await self.size())
 
     async def remove(self, bug_id: int, identifier: str):
-        bug_dir = self.location / f"{bug_id}"
-        item_path = bug_dir / (identifier + ".json")
+        bug_dir = os.path.join(self.location_str, str(bug_id))
+        item_path = os.path.join(bug_dir, identifier + ".json")
         try:
             logger.debug("Removing %s from queue for bug %s", identifier, bug_id)
-            item_path.unlink()
-        except FileNotFoundError as exc:
-            logger.warning(
-                "Could not delete missing item at path %s", str(item_path), exc
-            )
+            os.unlink(item_path)
+        except FileNotFoundError:
+            logger.warning("Could not delete missing item at path %s", item_path)
+            if not os.path.isdir(bug_dir):
+                return
 
-        if not any(bug_dir.iterdir()):
-            bug_dir.rmdir()
-            logger.debug("Removed directory for bug %s", bug_id)
+        if any(True for _ in iter_json_files(bug_dir)):
+            return
+        with os.scandir(bug_dir) as entries:
+            tmp_files = [e.path for e in entries if e.name.endswith(".json.tmp")]
+        for tmp_path in tmp_files:
+            # Left behind by a crashed write, unless it is still being written.
+            with contextlib.suppress(FileNotFoundError):
+                if time.time() - os.path.getmtime(tmp_path) > STALE_TMP_FILE_SECONDS:
+                    os.unlink(tmp_path)
+        try:
+            os.rmdir(bug_dir)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            # Another item is being written for this bug.
+            return
+        logger.debug("Removed directory for bug %s", bug_id)
 
     async def exists(self, item_id: str) -> bool:
         try:
@@ -237,42 +302,66 @@ class FileBackend(QueueBackend):
         # even though pathlib.Path.exists() returns a bool, mypy doesn't seem to get it
         return bool(item_path.exists())
 
+    async def has_items(self, bug_id: int) -> bool:
+        return any(True for _ in iter_json_files(self.location / str(bug_id)))
+
     async def get(self, bug_id: int) -> AsyncIterator[QueueItem]:
         folder = self.location / str(bug_id)
-        if not folder.is_dir():
-            return
-            yield
-        for path in sorted(folder.iterdir()):
+        # Identifiers start with the event timestamp, hence sorting file
+        # names is enough to yield items in chronological order.
+        entries = sorted(iter_json_files(folder), key=lambda entry: entry.name)
+        for entry in entries:
+            path = Path(entry.path)
+            # Don't block the event loop (e.g. incoming webhooks) on disk reads.
+            content = await asyncio.to_thread(path.read_bytes)
             try:
-                yield QueueItem.parse_file(path)
-            except (JSONDecodeError, ValidationError) as e:
+                yield QueueItem.model_validate_json(content)
+            except ValidationError as e:
                 raise QueueItemRetrievalError(
                     "Unable to load item from queue", path=path
                 ) from e
 
     async def get_all(self) -> dict[int, AsyncIterator[QueueItem]]:
         all_items: dict[int, AsyncIterator[QueueItem]] = {}
-        for filesystem_object in self.location.iterdir():
-            if filesystem_object.is_dir() and re.match(
-                r"\d", filesystem_object.name
-            ):  # filtering out temp files from checks
-                all_items[int(filesystem_object.name)] = self.get(filesystem_object)
+        with os.scandir(self.location) as entries:
+            for entry in entries:
+                # filtering out temp files from checks
+                if entry.is_dir() and re.fullmatch(r"[0-9]+", entry.name):
+                    bug_id = int(entry.name)
+                    # Skip folders left without items, e.g. by a crashed write.
+                    if await self.has_items(bug_id):
+                        all_items[bug_id] = self.get(bug_id)
         return all_items
 
     async def size(self, bug_id=None) -> int:
         location = self.location / str(bug_id) if bug_id else self.location
-        return sum(1 for _ in location.rglob("*.json"))
+        return sum(1 for _ in iter_json_files(location))
 
 
 class DeadLetterQueue:
     backend: QueueBackend
 
     def __init__(self, dsn: FileUrl | str | ParseResult):
-        dsn = urlparse(url=dsn) if isinstance(dsn, str) else dsn
-
-        if dsn.scheme != "file":
-            raise InvalidQueueDSNError(f"{dsn.scheme} is not supported")
-        self.backend = FileBackend(dsn.path)
+        path: Optional[str]
+        if isinstance(dsn, str):
+            scheme, _, path = dsn.partition("://")
+            # Only parse the full URL if it isn't a plain `file:///<path>`.
+            if (
+                scheme != "file"
+                or not path.startswith("/")
+                or "?" in path
+                or "#" in path
+            ):
+                parsed = urlparse(url=dsn)
+                scheme, path = parsed.scheme, parsed.path
+        else:
+            scheme, path = dsn.scheme, dsn.path
+
+        if scheme != "file":
+            raise InvalidQueueDSNError(f"{scheme} is not supported")
+        if not path:
+            raise InvalidQueueDSNError(f"{dsn} has no path")
+        self.backend = FileBackend(path)
 
     def check_writable(self) -> list[dockerflow.checks.CheckMessage]:
         """Heartbeat check to assert we can write items to queue"""
@@ -293,10 +382,9 @@ class DeadLetterQueue:
         try:
             bugs = await self.retrieve()
 
-            for bug_id, items in bugs.items():
+            for items in bugs.values():
                 try:
-                    bug_items = (await self.retrieve()).values()
-                    [[i async for i in items] for items in bug_items]
+                    [_ async for _ in items]
                 except QueueItemRetrievalError as exc:
                     results.append(
                         dockerflow.checks.Error(
@@ -342,8 +430,7 @@ class DeadLetterQueue:
         Return `True` if the specified `payload` is blocked and should be
         queued instead of being processed.
         """
-        existing = await self.backend.size(payload.bug.id)
-        return existing > 0
+        return await self.backend.has_items(payload.bug.id)
 
     async def retrieve(self) -> dict[int, AsyncIterator[QueueItem]]:
         """
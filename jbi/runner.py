@@ -195,7 +195,8 @@ async def execute_or_queue(
             item.identifier,
             extra={
                 "payload": request.model_dump(),
-                "item": item.model_dump(),
+                # The traceback is already logged via `exc_info`.
+                "item": item.model_dump(exclude={"error": {"details"}}),
             },
         )
         return {"status": "failed", "error": str(exc)}
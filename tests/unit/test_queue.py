@@ -1,15 +1,22 @@
 import json
+import logging
+import os
+import time
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
 import pytest
-from pydantic import HttpUrl
+from pydantic import FileUrl, HttpUrl
 
 from jbi.queue import (
     DeadLetterQueue,
     FileBackend,
     InvalidQueueDSNError,
+    PythonException,
     QueueBackend,
+    QueueItem,
     QueueItemRetrievalError,
+    iter_json_files,
 )
 
 
@@ -24,13 +31,62 @@ def queue(tmp_path):
 
 
 @pytest.mark.parametrize(
-    "dsn", ["memory://", "http://www.example.com", HttpUrl("http://www.example.com")]
+    "dsn",
+    [
+        "memory://",
+        "http://www.example.com",
+        HttpUrl("http://www.example.com"),
+        "file://",
+        "file://localhost",
+        urlparse("file://localhost"),
+    ],
 )
 def test_invalid_queue_url(dsn):
     with pytest.raises(InvalidQueueDSNError):
         DeadLetterQueue(dsn)
 
 
+def test_iter_json_files(tmp_path):
+    (tmp_path / "1").mkdir()
+    (tmp_path / "1" / "a.json").write_text("{}")
+    (tmp_path / "1" / "b.json.tmp").write_text("{}")
+    (tmp_path / "2").mkdir()
+    (tmp_path / "2" / "c.json").write_text("{}")
+    (tmp_path / "d.json").write_text("{}")
+    (tmp_path / "empty").mkdir()
+
+    assert sorted(entry.name for entry in iter_json_files(tmp_path)) == [
+        "a.json",
+        "c.json",
+        "d.json",
+    ]
+
+
+def test_iter_json_files_missing_folder(tmp_path):
+    assert list(iter_json_files(tmp_path / "missing")) == []
+
+
+@pytest.mark.parametrize("to_dsn", [str, FileUrl, urlparse])
+def test_file_queue_url(to_dsn, tmp_path):
+    queue = DeadLetterQueue(to_dsn("file://" + str(tmp_path)))
+    assert queue.backend.location == tmp_path
+
+
+@pytest.mark.parametrize(
+    "prefix,suffix",
+    [
+        ("file://localhost", ""),
+        ("file:", ""),
+        ("FILE://", ""),
+        ("file://", "?x=1"),
+        ("file://", "#f"),
+    ],
+)
+def test_file_queue_url_variants(prefix, suffix, tmp_path):
+    queue = DeadLetterQueue(prefix + str(tmp_path) + suffix)
+    assert queue.backend.location == tmp_path
+
+
 def test_ping(backend: QueueBackend):
     assert backend.ping() is True
 
@@ -55,6 +111,18 @@ async def test_backend_remove_last_item(backend: QueueBackend, queue_item_factor
     assert await backend.size() == 0
 
 
+@pytest.mark.asyncio
+async def test_backend_remove_missing_bug(backend: QueueBackend, capturelogs):
+    with capturelogs.for_logger("jbi.queue").at_level(logging.WARNING):
+        await backend.remove(999, "2024-04-18 12:46:54+00:00-999-create-error")
+
+    assert await backend.size() == 0
+    assert capturelogs.messages == [
+        f"Could not delete missing item at path {backend.location / '999'}"
+        "/2024-04-18 12:46:54+00:00-999-create-error.json"
+    ]
+
+
 @pytest.mark.asyncio
 async def test_backend_clear(backend: QueueBackend, queue_item_factory):
     item_1 = queue_item_factory(payload__bug__id=123)
@@ -68,6 +136,93 @@ async def test_backend_clear(backend: QueueBackend, queue_item_factory):
     assert await backend.size() == 0
 
 
+@pytest.mark.asyncio
+async def test_backend_put_after_bug_folder_removed(
+    backend: QueueBackend, queue_item_factory
+):
+    item_1 = queue_item_factory(payload__bug__id=123)
+    item_2 = queue_item_factory(payload__bug__id=123, error=None)
+
+    await backend.put(item_1)
+    await backend.remove(123, item_1.identifier)
+    assert not (backend.location / "123").exists()
+
+    await backend.put(item_2)
+    assert [item async for item in backend.get(123)] == [item_2]
+
+
+@pytest.mark.asyncio
+async def test_backend_put_leaves_no_temporary_file(
+    backend: QueueBackend, queue_item_factory
+):
+    item = queue_item_factory(payload__bug__id=123)
+    await backend.put(item)
+
+    assert [p.name for p in (backend.location / "123").iterdir()] == [
+        f"{item.identifier}.json"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_backend_put_failure_removes_temporary_file(
+    backend: QueueBackend, queue_item_factory, mocker
+):
+    item = queue_item_factory(payload__bug__id=123)
+    mocker.patch.object(
+        QueueItem, "model_dump_json", side_effect=OSError("No space left on device")
+    )
+
+    with pytest.raises(OSError):
+        await backend.put(item)
+
+    assert not (backend.location / "123").exists()
+    assert await backend.get_all() == {}
+
+
+@pytest.mark.asyncio
+async def test_backend_remove_cleans_up_stale_temporary_file(
+    backend: QueueBackend, queue_item_factory
+):
+    bug_dir = backend.location / "123"
+    bug_dir.mkdir()
+    stale_tmp = bug_dir / "xxx.json.tmp"
+    stale_tmp.write_text('{"payl')
+    an_hour_ago = time.time() - 3600
+    os.utime(stale_tmp, (an_hour_ago, an_hour_ago))
+    assert await backend.get_all() == {}
+
+    item = queue_item_factory(payload__bug__id=123)
+    await backend.put(item)
+    await backend.remove(123, item.identifier)
+
+    assert not bug_dir.exists()
+
+
+@pytest.mark.asyncio
+async def test_backend_remove_keeps_fresh_temporary_file(
+    backend: QueueBackend, queue_item_factory
+):
+    item = queue_item_factory(payload__bug__id=123)
+    await backend.put(item)
+    (backend.location / "123" / "xxx.json.tmp").write_text('{"payl')
+
+    await backend.remove(123, item.identifier)
+
+    assert [p.name for p in (backend.location / "123").iterdir()] == ["xxx.json.tmp"]
+
+
+@pytest.mark.asyncio
+async def test_backend_get_ignores_partially_written_item(
+    backend: QueueBackend, queue_item_factory
+):
+    item = queue_item_factory(payload__bug__id=123)
+    await backend.put(item)
+    (backend.location / "123" / "xxx.json.tmp").write_text('{"payl')
+
+    assert [i async for i in backend.get(123)] == [item]
+    assert await backend.size() == 1
+
+
 @pytest.mark.asyncio
 async def test_backend_put_maintains_sorted_order(
     backend: QueueBackend, queue_item_factory
@@ -163,6 +318,22 @@ async def test_backend_get_all_ignores_bad_folders(
     assert len(items) == 1
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("folder_name", ["4tmpfolder", "²", "٣"])
+async def test_backend_get_all_ignores_folders_starting_with_digit(
+    backend: QueueBackend, queue_item_factory, folder_name
+):
+    item_1 = queue_item_factory(payload__bug__id=123)
+    await backend.put(item_1)
+
+    (backend.location / folder_name).mkdir()
+    (backend.location / folder_name / "xxx.json").write_text("{}")
+
+    items = await backend.get_all()
+    assert list(items) == [123]
+    assert [item async for item in items[123]] == [item_1]
+
+
 @pytest.mark.asyncio
 async def test_backend_get_all_payload_doesnt_match_schema(
     backend: QueueBackend, queue_item_factory
@@ -193,6 +364,51 @@ async def test_backend_get_invalid_json(backend: QueueBackend, queue_item_factor
         await anext(items)
 
 
+@pytest.mark.asyncio
+async def test_backend_get_ignores_non_json_files(
+    backend: QueueBackend, queue_item_factory
+):
+    item = queue_item_factory(payload__bug__id=999)
+    await backend.put(item)
+    (backend.location / "999" / "notes.txt").write_text("BOOM")
+
+    assert [i async for i in backend.get(999)] == [item]
+
+
+@pytest.mark.asyncio
+async def test_backend_get_reads_same_files_as_size(
+    backend: QueueBackend, queue_item_factory
+):
+    item = queue_item_factory(payload__bug__id=999)
+    await backend.put(item)
+    subfolder = backend.location / "999" / "sub"
+    subfolder.mkdir()
+    (backend.location / "999" / f"{item.identifier}.json").rename(
+        subfolder / f"{item.identifier}.json"
+    )
+
+    assert await backend.size(999) == 1
+    assert await backend.has_items(999) is True
+    assert [i async for i in backend.get(999)] == [item]
+
+
+@pytest.mark.asyncio
+async def test_backend_get_missing_bug(backend: QueueBackend):
+    assert [i async for i in backend.get(999)] == []
+
+
+@pytest.mark.asyncio
+async def test_backend_has_items(backend: QueueBackend, queue_item_factory):
+    item = queue_item_factory(payload__bug__id=123)
+    await backend.put(item)
+
+    assert await backend.has_items(123) is True
+    assert await backend.has_items(456) is False
+
+    await backend.remove(123, item.identifier)
+    assert await backend.has_items(123) is False
+
+
 @pytest.mark.asyncio
 async def test_get_missing_timezone(backend: QueueBackend, queue_item_factory):
     item = queue_item_factory.build(payload__bug__id=666)
@@ -255,6 +471,21 @@ async def test_check_readable_not_parseable(queue: DeadLetterQueue):
     assert failure.hint.startswith("check that parked event files are not corrupt")
 
 
+@pytest.mark.asyncio
+async def test_check_readable_reports_each_corrupt_bug_once(
+    queue: DeadLetterQueue, queue_item_factory
+):
+    await queue.backend.put(queue_item_factory(payload__bug__id=123))
+    await queue.backend.put(queue_item_factory(payload__bug__id=456))
+    corrupt_file_dir = queue.backend.location / "999"
+    corrupt_file_dir.mkdir()
+    (corrupt_file_dir / "xxx.json").write_text("BOOM")
+
+    [failure] = await queue.check_readable()
+    assert failure.id == "queue.backend.read"
+    assert "999" in failure.msg
+
+
 @pytest.mark.asyncio
 async def test_postpone(queue: DeadLetterQueue, webhook_request_factory):
     webhook_payload = webhook_request_factory()
@@ -279,6 +510,18 @@ async def test_track_failed(queue: DeadLetterQueue, webhook_request_factory):
     assert item.rid == "rid"
 
 
+def test_python_exception_from_exc():
+    try:
+        raise ValueError("boom")
+    except ValueError as exc:
+        error = PythonException.from_exc(exc)
+
+    assert error.type == "ValueError"
+    assert error.description == "boom"
+    assert error.details.startswith("Traceback (most recent call last):")
+    assert error == PythonException.model_validate_json(error.model_dump_json())
+
+
 @pytest.mark.asyncio
 async def test_is_blocked(
     queue: DeadLetterQueue, queue_item_factory, webhook_request_factory
@@ -333,6 +333,23 @@ async def test_execute_or_queue_exception(
     mock_queue.track_failed.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_execute_or_queue_exception_logs_traceback_once(
+    actions,
+    dl_queue,
+    bugzilla_webhook_request,
+    capturelogs,
+):
+    with capturelogs.for_logger("jbi.runner").at_level(logging.ERROR):
+        await execute_or_queue(
+            request=bugzilla_webhook_request, queue=dl_queue, actions=actions
+        )
+
+    [record] = [r for r in capturelogs.records if r.msg.startswith("Failed to process")]
+    assert record.exc_info is not None
+    assert "details" not in record.item["error"]
+
+
 @pytest.mark.asyncio
 @pytest.mark.no_mocked_bugzilla
 @pytest.mark.no_mocked_jira